@@ -1,7 +1,15 @@
 import os
 import logging
+import logging.handlers
+import copy
 import tempfile
 import json
+import threading
+import time
+import queue
+import random
+import atexit
+import contextvars
 from flask import Flask, request, jsonify, render_template_string
 from telegram import Update, Bot, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
@@ -14,6 +22,7 @@ from telegram.ext import (
 )
 from dotenv import load_dotenv
 from functools import wraps
+from collections import OrderedDict
 
 # Load environment variables from .env file
 load_dotenv()
@@ -25,6 +34,17 @@ class Config:
     SUPPORTED_LANGUAGES = ['en', 'ru', 'uz']
     DEFAULT_LANGUAGE = 'ru'
     REQUIRED_CHANNELS = ['@xtarjima', '@moshinabozorim_n']
+    # Admission control for downloads and audio recognition
+    USER_RATE = float(os.getenv('USER_RATE', '0.2'))  # jobs per second
+    USER_BURST = int(os.getenv('USER_BURST', '3'))
+    CHAT_RATE = float(os.getenv('CHAT_RATE', '0.5'))
+    CHAT_BURST = int(os.getenv('CHAT_BURST', '5'))
+    MAX_USER_JOBS = int(os.getenv('MAX_USER_JOBS', '1'))
+    MAX_INFLIGHT_JOBS = int(os.getenv('MAX_INFLIGHT_JOBS', '8'))
+    NOTICE_COOLDOWN = float(os.getenv('NOTICE_COOLDOWN', '30'))  # seconds between "please wait" replies
+    # Logging
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+    LOG_INFO_SAMPLE_RATE = float(os.getenv('LOG_INFO_SAMPLE_RATE', '1.0'))
 
 # Locales (previously locales/*.json files, now as dictionaries)
 LOCALES = {
@@ -56,6 +76,9 @@ LOCALES = {
         "error": "❌ An error occurred: {error}",
         "unsupported": "❌ Unsupported platform",
         "audio_recognizing": "🎵 Recognizing audio, please wait...",
+        "rate_limited": "⏳ You are sending requests too fast, please wait a moment and try again.",
+        "busy": "⏳ Please wait for your previous request to finish.",
+        "overloaded": "⏳ The bot is busy right now, please try again in a moment.",
         "subscribe_prompt": "📢 To use the bot, please subscribe to the following channels:",
         "subscribed_success": "✅ Thank you for subscribing! You can now use the bot.",
         "not_subscribed": "❌ You are not subscribed to all required channels. Please subscribe and try again.",
@@ -102,6 +125,9 @@ LOCALES = {
         "error": "❌ Произошла ошибка: {error}",
         "unsupported": "❌ Неподдерживаемая платформа",
         "audio_recognizing": "🎵 Распознаю аудио, пожалуйста подождите...",
+        "rate_limited": "⏳ Вы отправляете запросы слишком часто, пожалуйста подождите немного и попробуйте снова.",
+        "busy": "⏳ Пожалуйста дождитесь завершения предыдущего запроса.",
+        "overloaded": "⏳ Бот сейчас занят, пожалуйста попробуйте снова через минуту.",
         "subscribe_prompt": "📢 Для использования бота, пожалуйста, подпишитесь на следующие каналы:",
         "subscribed_success": "✅ Спасибо за подписку! Теперь вы можете использовать бота.",
         "not_subscribed": "❌ Вы не подписаны на все необходимые каналы. Пожалуйста, подпишитесь и попробуйте снова.",
@@ -148,6 +174,9 @@ LOCALES = {
         "error": "❌ Xatolik yuz berdi: {error}",
         "unsupported": "❌ Qo'llab-quvvatlanmaydigan platforma",
         "audio_recognizing": "🎵 Audiyni aniqlashmoqda, iltimos kuting...",
+        "rate_limited": "⏳ Siz so'rovlarni juda tez yuboryapsiz, iltimos biroz kuting va qayta urinib ko'ring.",
+        "busy": "⏳ Iltimos, oldingi so'rovingiz tugashini kuting.",
+        "overloaded": "⏳ Bot hozir band, iltimos birozdan so'ng qayta urinib ko'ring.",
         "subscribe_prompt": "📢 Botdan foydalanish3e3e dalanish uchun quyidagi kanallarga obuna bo'ling:",
         "subscribed_success": "✅ Obuna bo'lganingiz uchun rahmat! Endi botdan foydalanishingiz mumkin.",
         "not_subscribed": "❌ Siz barcha kerakli kanallarga obuna bo'lmagansiz. Iltimos, obuna bo'lib qayta urinib ko'ring.",
@@ -199,7 +228,7 @@ def check_subscription(bot: Bot, user_id: int) -> bool:
             if member.status not in ['member', 'administrator', 'creator']:
                 return False
         except Exception as e:
-            logger.error(f"Error checking subscription for {channel}: {e}")
+            logger.error("Error checking subscription for %s: %s", channel, e)
             return False
     return True
 
@@ -269,6 +298,142 @@ def recognize_audio(file_path):
     # Implement actual audio recognition logic
     return {'title': 'Song Title', 'artist': 'Artist Name', 'lyrics': 'Lyrics not available'}
 
+# Admission control
+SUPPORTED_DOMAINS = ['instagram.com', 'tiktok.com', 'youtube.com', 'snapchat.com', 'likee.video', 'pinterest.com', 'threads.net']
+
+class TokenBucket:
+    """Token bucket refilled at `rate` tokens per second up to `capacity`."""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+class AdmissionController:
+    """Per-user and per-chat rate limits plus concurrency caps for expensive jobs.
+
+    State lives in process memory, so limits apply per serverless instance
+    and are best-effort across the deployment.
+    """
+    MAX_BUCKETS = 10000
+
+    def __init__(self, user_rate, user_burst, chat_rate, chat_burst, max_user_jobs, max_jobs, notice_cooldown):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_user_jobs = max_user_jobs
+        self.max_jobs = max_jobs
+        self.notice_cooldown = notice_cooldown
+        self._lock = threading.Lock()
+        self._user_buckets = OrderedDict()
+        self._chat_buckets = OrderedDict()
+        self._notified = OrderedDict()
+        self._user_jobs = {}
+        self._inflight = 0
+
+    def _bucket(self, buckets, key, rate, capacity, now):
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= self.MAX_BUCKETS:
+                # Evict the least recently used bucket, most likely refilled by now
+                buckets.popitem(last=False)
+            bucket = buckets[key] = TokenBucket(rate, capacity)
+        else:
+            buckets.move_to_end(key)
+        bucket.refill(now)
+        return bucket
+
+    def _should_notify(self, user_id, now):
+        """Allow at most one rejection notice per user per cooldown."""
+        last = self._notified.get(user_id)
+        if last is not None and now - last < self.notice_cooldown:
+            return False
+        if last is None and len(self._notified) >= self.MAX_BUCKETS:
+            self._notified.popitem(last=False)
+        self._notified[user_id] = now
+        self._notified.move_to_end(user_id)
+        return True
+
+    def _reason(self, user_id, chat_id, now):
+        if self._user_jobs.get(user_id, 0) >= self.max_user_jobs:
+            return 'busy'
+        if self._inflight >= self.max_jobs:
+            return 'overloaded'
+        user_bucket = self._bucket(self._user_buckets, user_id, self.user_rate, self.user_burst, now)
+        chat_bucket = self._bucket(self._chat_buckets, chat_id, self.chat_rate, self.chat_burst, now)
+        if user_bucket.tokens < 1 or chat_bucket.tokens < 1:
+            return 'rate_limited'
+        user_bucket.tokens -= 1
+        chat_bucket.tokens -= 1
+        return None
+
+    def acquire(self, user_id, chat_id):
+        """Admit a job.
+
+        Returns a `(reason, notify)` tuple. `reason` is None if admitted,
+        otherwise the locale key to reply with; `notify` is False when the
+        user was already told to wait within the cooldown.
+        """
+        with self._lock:
+            now = time.monotonic()
+            reason = self._reason(user_id, chat_id, now)
+            if reason:
+                return reason, self._should_notify(user_id, now)
+            self._user_jobs[user_id] = self._user_jobs.get(user_id, 0) + 1
+            self._inflight += 1
+            return None, False
+
+    def release(self, user_id):
+        """Release a job slot taken by `acquire`."""
+        with self._lock:
+            self._inflight -= 1
+            jobs = self._user_jobs.get(user_id, 1) - 1
+            if jobs > 0:
+                self._user_jobs[user_id] = jobs
+            else:
+                self._user_jobs.pop(user_id, None)
+
+admission = AdmissionController(
+    Config.USER_RATE, Config.USER_BURST,
+    Config.CHAT_RATE, Config.CHAT_BURST,
+    Config.MAX_USER_JOBS, Config.MAX_INFLIGHT_JOBS,
+    Config.NOTICE_COOLDOWN
+)
+
+def is_expensive_message(message):
+    """Return True if the message would start a download or audio recognition."""
+    if message is None:
+        return False
+    if message.text:
+        return any(domain in message.text for domain in SUPPORTED_DOMAINS)
+    return bool(message.voice or message.audio)
+
+def admission_control(func):
+    """Reject expensive messages over the rate or concurrency limits before any I/O."""
+    @wraps(func)
+    def wrapper(update, context, *args, **kwargs):
+        if not is_expensive_message(update.message):
+            return func(update, context, *args, **kwargs)
+        user_id = update.effective_user.id
+        reason, notify = admission.acquire(user_id, update.effective_chat.id)
+        if reason:
+            # Repeated rejections are dropped silently to save outbound API calls
+            if notify:
+                lang = get_user_language(user_id) or Config.DEFAULT_LANGUAGE
+                update.message.reply_text(get_translation(lang, reason))
+            return None
+        try:
+            return func(update, context, *args, **kwargs)
+        finally:
+            admission.release(user_id)
+    return wrapper
+
 # Templates (previously templates/result.html, now as a string)
 RESULT_HTML = """
 <!DOCTYPE html>
@@ -426,13 +591,105 @@ app.config.from_object(Config)
 # Initialize bot
 bot = Bot(token=app.config['TELEGRAM_TOKEN'])
 
-# Enable logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Logging
+# Trace context of the update being processed, attached to every log record
+trace_context = contextvars.ContextVar('trace_context', default={})
+
+class TraceContextFilter(logging.Filter):
+    """Attach update_id/chat_id from the current trace context to the record."""
+    def filter(self, record):
+        trace = trace_context.get()
+        record.update_id = trace.get('update_id')
+        record.chat_id = trace.get('chat_id')
+        return True
+
+class SamplingFilter(logging.Filter):
+    """Keep only a fraction of INFO and lower records; warnings are always kept."""
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.INFO or self.rate >= 1 or random.random() < self.rate
+
+class JsonFormatter(logging.Formatter):
+    """Format records as compact single-line JSON."""
+    def format(self, record):
+        data = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'update_id': getattr(record, 'update_id', None),
+            'chat_id': getattr(record, 'chat_id', None)
+        }
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['exc'] = record.exc_text
+        if record.stack_info:
+            data['stack'] = record.stack_info
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':'), default=str)
+
+class SnapshotQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that snapshots kept records and leaves JSON encoding to the listener.
+
+    Records dropped by the level check or filters never reach `prepare`, so
+    only kept records pay for `msg % args` and traceback formatting here.
+    """
+    def prepare(self, record):
+        # Work on a copy so handlers after this one still see args and exc_info
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def setup_logging():
+    """Route log records through a queue to a background JSON writer.
+
+    Handlers installed by the host runtime are left in place. Calling this
+    again, e.g. after the debug reloader re-imports the module, reuses the
+    listener that is already running.
+    """
+    root = logging.getLogger()
+    for existing in root.handlers:
+        if getattr(existing, 'json_log_listener', None):
+            return existing.json_log_listener
+
+    log_queue = queue.Queue()
+    handler = SnapshotQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter(Config.LOG_INFO_SAMPLE_RATE))
+    handler.addFilter(TraceContextFilter())
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    handler.json_log_listener = listener
+    root.addHandler(handler)
+    level = logging.getLevelName(Config.LOG_LEVEL.upper())
+    root.setLevel(level if isinstance(level, int) else logging.INFO)
+    return listener
+
+def flush_logs(timeout=1.0):
+    """Wait until the listener has written every queued record."""
+    log_queue = log_listener.queue
+    with log_queue.all_tasks_done:
+        log_queue.all_tasks_done.wait_for(lambda: not log_queue.unfinished_tasks, timeout)
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 
+@app.teardown_request
+def flush_logs_on_teardown(exc):
+    """Drain queued logs before returning; serverless instances freeze right after."""
+    flush_logs()
+
 # States for conversation handler
 SELECTING_ACTION, SELECTING_PLATFORM, PROCESSING_LINK = range(3)
 
@@ -558,6 +815,7 @@ def handle_platform_selection(update, context):
     query.answer()
     return PROCESSING_LINK
 
+@admission_control
 @send_typing_action
 @check_subscription_middleware
 def handle_message(update, context):
@@ -566,7 +824,7 @@ def handle_message(update, context):
     lang = get_user_language(user_id) or app.config['DEFAULT_LANGUAGE']
     message = update.message.text if update.message.text else None
     
-    if message and any(domain in message for domain in ['instagram.com', 'tiktok.com', 'youtube.com', 'snapchat.com', 'likee.video', 'pinterest.com', 'threads.net']):
+    if message and any(domain in message for domain in SUPPORTED_DOMAINS):
         update.message.reply_text(get_translation(lang, 'processing'))
         
         try:
@@ -576,7 +834,7 @@ def handle_message(update, context):
             else:
                 send_content(update, result, lang)
         except Exception as e:
-            logger.error(f"Error processing link: {e}")
+            logger.error("Error processing link: %s", e)
             update.message.reply_text(get_translation(lang, 'error').format(error=str(e)))
     
     elif update.message.voice or update.message.audio:
@@ -601,7 +859,7 @@ def handle_message(update, context):
             else:
                 update.message.reply_text(get_translation(lang, 'song.not_recognized'))
         except Exception as e:
-            logger.error(f"Error recognizing audio: {e}")
+            logger.error("Error recognizing audio: %s", e)
             update.message.reply_text(get_translation(lang, 'error').format(error=str(e)))
     else:
         update.message.reply_text(get_translation(lang, 'instructions'))
@@ -629,7 +887,7 @@ def send_content(update, content, lang):
 
 def error(update, context):
     """Log Errors caused by Updates."""
-    logger.warning('Update "%s" caused error "%s"', update, context.error)
+    logger.warning('Update caused error "%s"', context.error, exc_info=context.error)
 
 def setup_dispatcher(dp):
     """Set up the command handlers."""
@@ -664,7 +922,14 @@ def webhook():
     update = Update.de_json(request.get_json(force=True), bot)
     dp = Dispatcher(bot, None, workers=0)
     dp = setup_dispatcher(dp)
-    dp.process_update(update)
+    token = trace_context.set({
+        'update_id': update.update_id,
+        'chat_id': update.effective_chat.id if update.effective_chat else None
+    })
+    try:
+        dp.process_update(update)
+    finally:
+        trace_context.reset(token)
     return jsonify({'status': 'ok'})
 
 @app.route('/set_webhook', methods=['GET', 'POST'])